@@ -104,6 +104,10 @@ class DownstreamHandler:
         self.queue = Queue.Queue(5)
         self.gwMacToAddrMap = {}
         self.pullAckPacket = bytearray([PROTOCOL_VERSION, 0, 0, PULL_ACK_ID])
+        # PULL_RESP carries no token, so its header never changes and can be
+        # prepended as a constant instead of rebuilding a bytearray per send.
+        self.pullRespHeader = str(bytearray([PROTOCOL_VERSION, 0, 0,
+                                             PULL_RESP_ID]))
 
         self.exitFlag = False
         self.logger = logging.getLogger("DownstreamHandler")
@@ -116,15 +120,13 @@ class DownstreamHandler:
         # Determine the internet address of the gateway
         if macAddr not in self.gwMacToAddrMap:
             self.logger.error("[Downstream] Send failed. Gateway %x not " \
-                              "connected."%macAddr)
+                              "connected.", macAddr)
             return errno.ENONET
         else:
             udpAddr = self.gwMacToAddrMap[macAddr]
 
         # form the payload and send it
-        payload = bytearray([PROTOCOL_VERSION, 0, 0, PULL_RESP_ID])
-        payload.extend(jsonPayload)
-        self.queueDown.put((payload, udpAddr))
+        self.queueDown.put((self.pullRespHeader + jsonPayload, udpAddr))
 
     def shutdown(self):
         self.exitFlag = True
@@ -153,10 +155,10 @@ class DownstreamHandler:
                     elif addr != self.gwMacToAddrMap[macAddr]:
                         self.logger.warning("Gateway %x appears to have " \
                                             "changed internet address from " \
-                                            "%s:%d to %s:%d"%(macAddr,
-                                             self.gwMacToAddrMap[macAddr][0],
-                                             self.gwMacToAddrMap[macAddr][1],
-                                             addr[0], addr[1]))
+                                            "%s:%d to %s:%d", macAddr,
+                                            self.gwMacToAddrMap[macAddr][0],
+                                            self.gwMacToAddrMap[macAddr][1],
+                                            addr[0], addr[1])
                         # overwrite the old internet address
                         self.gwMacToAddrMap[macAddr] = addr
 
@@ -296,7 +298,7 @@ class PushDataWorker(threading.Thread):
                 self.macAddr = macAddr
             elif (self.macAddr != macAddr):
                 self.logger.warning("Got unexpected MAC address: " \
-                                    "%x. Expected %x."%(macAddr, self.macAddr))
+                                    "%x. Expected %x.", macAddr, self.macAddr)
                 return None
 
             # Retrieve JSON payload
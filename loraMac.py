@@ -1,7 +1,10 @@
-from multiprocessing import Queue
+from multiprocessing import Queue, cpu_count
+from concurrent.futures import ThreadPoolExecutor
 import threading
-import base64
-from CryptoPlus.Cipher import python_AES # PyCryptoPlus
+import pybase64 # SIMD-accelerated base64 codec
+import hmac
+from Cryptodome.Cipher import AES # pycryptodome (AES-NI accelerated)
+from Cryptodome.Hash import CMAC
 import random
 import logging
 import struct
@@ -13,6 +16,29 @@ import numpy
 DOWNLINK_QUEUE_MAX_SIZE = 32
 DEVNONCE_HISTORY_LEN = 5
 
+# Precomputed zero pads, indexed by the number of pad bytes needed
+_ZERO_PADS = [b'\x00' * i for i in range(16)]
+
+# Precompiled packers, so the fixed LoRaWAN layouts are emitted with one C
+# call instead of re-parsing a format string per packet. AppNonce and NetID
+# are both 24-bit fields, so they are packed together as a single 48-bit
+# little-endian value and sliced to 6 bytes.
+_NONCE_NETID_STRUCT = struct.Struct("<Q")
+_JOIN_ACCEPT_TAIL_STRUCT = struct.Struct("<LBB") # DevAddr, DLSettings, RxDelay
+_SESSION_KEY_TAIL_STRUCT = struct.Struct("<H7x") # DevNonce + zero padding
+_MIC_B0_STRUCT = struct.Struct("<B4xBLLBB")
+_JOIN_REQ_STRUCT = struct.Struct("<QQH") # AppEUI, DevEUI, DevNonce
+
+# OS-entropy-backed generator for device addresses and AppNonces. The
+# Mersenne Twister behind the plain random functions is predictable, which
+# would let an eavesdropper anticipate JoinAccept nonces.
+_sysRandom = random.SystemRandom()
+
+def _euiMapKey(appEUI, devEUI):
+    # Pack both 64-bit EUIs into a single int so a device lookup hashes one
+    # key instead of allocating and hashing a 2-tuple per packet
+    return (appEUI << 64) | devEUI
+
 class LoRaMacCrypto:
     CRYPTO_BLOCK_SIZE = 16
 
@@ -20,28 +46,29 @@ class LoRaMacCrypto:
         self.appKeyStr = appKeyStr
         self.nwkSKeyStr = ''
         self.appSKeyStr = ''
+        # The AppKey never changes, so its AES and CMAC objects can be built
+        # once instead of once per join request. The CMAC object is used as a
+        # template: copy() it before update() so each MIC starts fresh.
+        self.aesWithAppKey = AES.new(appKeyStr, AES.MODE_ECB)
+        self.cmacWithAppKey = CMAC.new(appKeyStr, ciphermod=AES)
         self.aesWithNwkSKey = None # Set during a device's join process
         self.aesWithAppSKey = None
+        self.cmacWithNwkSKey = None
 
     def setSessionKeys(self, nwkSKeyStr, appSKeyStr):
-        # Create AES and CMAC objects that can be reused. But remember to reset
-        # them after each encryption operation
-        self.aesWithNwkSKey = python_AES.new(nwkSKeyStr, python_AES.MODE_ECB)
-        self.aesWithAppSKey = python_AES.new(appSKeyStr, python_AES.MODE_ECB)
-        #self.cmacWithNwkSKey = python_AES.new(nwkSKeyStr, python_AES.MODE_CMAC)
+        # Create AES and CMAC objects that can be reused, saving a key
+        # schedule expansion per crypto call. ECB mode keeps no state between
+        # encrypt() calls so no resetting is needed; the CMAC template must
+        # be copy()'d before use.
+        self.aesWithNwkSKey = AES.new(nwkSKeyStr, AES.MODE_ECB)
+        self.aesWithAppSKey = AES.new(appSKeyStr, AES.MODE_ECB)
+        self.cmacWithNwkSKey = CMAC.new(nwkSKeyStr, ciphermod=AES)
         self.nwkSKeyStr = nwkSKeyStr
         self.appSKeyStr = appSKeyStr
 
     def padToBlockSize(self, byteStr):
-        # zero padding
-        if len(byteStr) % self.CRYPTO_BLOCK_SIZE != 0:
-            buf = byteStr + str(bytearray([0]* \
-                                (self.CRYPTO_BLOCK_SIZE-len(byteStr))))
-        else:
-            buf = byteStr
-
-        assert(len(buf) % self.CRYPTO_BLOCK_SIZE == 0)
-        return buf
+        # zero padding up to the next block boundary
+        return byteStr + _ZERO_PADS[-len(byteStr) % self.CRYPTO_BLOCK_SIZE]
 
     def computeJoinMic(self, byteStr):
         '''
@@ -51,8 +78,7 @@ class LoRaMacCrypto:
         LoRaWAN Specification v1.0 Ch6.2.4 and Ch6.2.5
         '''
         # no padding is needed
-        cmacWithAppKey = python_AES.new(self.appKeyStr, python_AES.MODE_CMAC)
-        return cmacWithAppKey.encrypt(byteStr)[:4]
+        return self.cmacWithAppKey.copy().update(byteStr).digest()[:4]
 
     def encryptJoinAccept(self, byteStr):
         '''
@@ -62,8 +88,7 @@ class LoRaMacCrypto:
         LoRaWAN Specification v1.0 Ch6.2.5
         '''
         paddedBuf = self.padToBlockSize(byteStr)
-        aesWithAppKey = python_AES.new(self.appKeyStr, python_AES.MODE_ECB)
-        return aesWithAppKey.decrypt(paddedBuf) # DECRYPT here is on purpose
+        return self.aesWithAppKey.decrypt(paddedBuf) # DECRYPT here is on purpose
 
     def deriveSessionKey(self, byteStr):
         '''
@@ -74,8 +99,7 @@ class LoRaMacCrypto:
         '''
         # Just to be certain that the buffer is padded
         paddedBuf = self.padToBlockSize(byteStr)
-        aesWithAppKey = python_AES.new(self.appKeyStr, python_AES.MODE_ECB)
-        return aesWithAppKey.encrypt(paddedBuf)
+        return self.aesWithAppKey.encrypt(paddedBuf)
 
     def computeFrameMic(self, msgStr, updown, devAddr, seqCnt, msgLen):
         '''
@@ -88,18 +112,11 @@ class LoRaMacCrypto:
         LoRaWAN Specification v1.0 Ch4.4
         '''
         # no padding is needed for CMAC. No finalizing needed either.
-        byteStr = str(bytearray([0x49, 0, 0, 0, 0, updown,
-                                 devAddr & 0xFF,
-                                 (devAddr >> 8) & 0xFF,
-                                 (devAddr >> 16) & 0xFF,
-                                 (devAddr >> 24) & 0xFF,
-                                 seqCnt & 0xFF,
-                                 (seqCnt >> 8) & 0xFF,
-                                 (seqCnt >> 16) & 0xFF,
-                                 (seqCnt >> 24) & 0xFF,
-                                 0, msgLen])) + msgStr
-        cmacWithNwkSKey = python_AES.new(self.nwkSKeyStr, python_AES.MODE_CMAC)
-        return cmacWithNwkSKey.encrypt(byteStr)[:4]
+        # msg is fed in a second update() so callers may pass a memoryview
+        # without a concat copy.
+        b0 = _MIC_B0_STRUCT.pack(0x49, updown, devAddr, seqCnt, 0, msgLen)
+        return self.cmacWithNwkSKey.copy().update(b0).update(msgStr) \
+                   .digest()[:4]
 
     def cipherCmdPayload(self, frmPayloadStr, updown, devAddr, seqCnt):
         return self.cipherPayload(self.aesWithNwkSKey, frmPayloadStr, updown,
@@ -111,7 +128,7 @@ class LoRaMacCrypto:
 
     def cipherPayload(self, aesWithKey, frmPayloadStr, updown, devAddr, seqCnt):
         '''
-        aesWithKey: a cipher object from CryptoPlus
+        aesWithKey: an ECB-mode cipher object from pycryptodome
         frmPayloadStr: | FRMPayload |
         updown: 0 for UP_LINK and 1 for DOWN_LINK
         devAddr (uint32): 4-byte device address
@@ -132,13 +149,12 @@ class LoRaMacCrypto:
                        0, 0])
 
         S = ''
-        aesWithKey.final() # clear the cipher's cache
         for i in xrange(1, k+1):
             A[15] = i
             S += aesWithKey.encrypt(str(A))
-        aesWithKey.final() # clear the cipher's cache
-        
-        dtype = numpy.dtype('<Q8')
+
+
+        dtype = numpy.dtype('<Q')
         ciphered = numpy.bitwise_xor(numpy.fromstring(paddedPaylod,dtype=dtype),
                                    numpy.fromstring(S,dtype=dtype)).tostring()
         return ciphered[:len(frmPayloadStr)]
@@ -179,6 +195,22 @@ class LoRaEndDevice:
         self.dlQueue = deque(maxlen=DOWNLINK_QUEUE_MAX_SIZE)
         self.lock = threading.RLock()
 
+        # Preformatted JSON templates for downlink assembly. All fields that
+        # are fixed per device are rendered once here; the per-packet fields
+        # are left as %-placeholders, so doDownlinkToDev does a single
+        # string interpolation instead of a dict build + json.dumps.
+        ipolJson = 'true' if self.dlIpol else 'false'
+        self.dlJsonTemplateRx1 = \
+            '{"txpk":{"freq":%%.6f,"datr":"%%s","codr":"%%s","tmst":%%d,' \
+            '"rfch":0,"powe":20,"modu":"%s","ipol":%s,"size":%%d,' \
+            '"data":"%%s"}}' % (self.dlModulation, ipolJson)
+        self.dlJsonTemplateRx2 = \
+            '{"txpk":{"freq":%.6f,"datr":"%s","codr":"%s","tmst":%%d,' \
+            '"rfch":0,"powe":20,"modu":"%s","ipol":%s,"size":%%d,' \
+            '"data":"%%s"}}' % (self.rx2FreqMHz, self.rx2Datarate,
+                                self.rx2Codingrate, self.dlModulation,
+                                ipolJson)
+
         self.logger = logging.getLogger("Dev(%x)"%devEUI)
         self.logger.setLevel(logging.INFO)
 
@@ -189,8 +221,7 @@ class LoRaEndDevice:
     #    self.lock.release()
     
     def onNewUplinkData(self, fPort, data):
-        self.logger.info("[Uplink Received] fPort:%d data:%s"%(fPort, 
-                                                               str(data)))
+        self.logger.info("[Uplink Received] fPort:%d data:%s", fPort, data)
 
     def canJoin(self, devNonce):
         return devNonce not in self.devNonceHistory
@@ -204,39 +235,22 @@ class LoRaEndDevice:
         self.devNonceHistory.append(devNonce)
 
         # derive the network session key and app session key
-        bufStr = str(bytearray([appNonce & 0xFF,
-                                (appNonce >> 8) & 0xFF,
-                                (appNonce >> 16) & 0xFF,
-                                netID & 0xFF,
-                                (netID >> 8) & 0xFF,
-                                (netID >> 16) & 0xFF,
-                                devNonce & 0xFF,
-                                (devNonce >> 8) & 0xFF,
-                                0,0,0,0,0,0,0]))
-        self.nwkSKeyStr = self.crypto.deriveSessionKey(str(bytearray([0x01])) +\
-                                                       bufStr)
-        self.appSKeyStr = self.crypto.deriveSessionKey(str(bytearray([0x02])) +\
-                                                       bufStr)
+        # | AppNonce (3) | NetID (3) | DevNonce (2) | zero padding (7) |
+        nonceNetID = _NONCE_NETID_STRUCT.pack(appNonce | (netID << 24))[:6]
+        bufStr = nonceNetID + _SESSION_KEY_TAIL_STRUCT.pack(devNonce)
+        self.nwkSKeyStr = self.crypto.deriveSessionKey(b'\x01' + bufStr)
+        self.appSKeyStr = self.crypto.deriveSessionKey(b'\x02' + bufStr)
         self.crypto.setSessionKeys(self.nwkSKeyStr, self.appSKeyStr)
-        self.logger.info("NwkSKey: %s"%self.nwkSKeyStr.encode('hex'))
-        self.logger.info("AppSKey: %s"%self.appSKeyStr.encode('hex'))
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("NwkSKey: %s", self.nwkSKeyStr.encode('hex'))
+            self.logger.info("AppSKey: %s", self.appSKeyStr.encode('hex'))
 
         # compose the join-accept message
-        mhdr = str(bytearray([MTYPE_JOIN_ACCEPT_MASK | \
-                              MAJOR_VERSION_LORAWAN]))
-        payload = str(bytearray([ appNonce & 0xFF,
-                                  (appNonce >> 8) & 0xFF,
-                                  (appNonce >> 16) & 0xFF,
-                                  netID & 0xFF,
-                                  (netID >> 8) & 0xFF,
-                                  (netID >> 16) & 0xFF,
-                                  newDevAddr & 0xFF,
-                                  (newDevAddr >> 8) & 0xFF,
-                                  (newDevAddr >> 16) & 0xFF,
-                                  (newDevAddr >> 24) & 0xFF,
-                                  0, # DLSettings
-                                  0, # RxDelay
-                                ]))
+        # | AppNonce (3) | NetID (3) | DevAddr (4) | DLSettings | RxDelay |
+        mhdr = chr(MTYPE_JOIN_ACCEPT_MASK | MAJOR_VERSION_LORAWAN)
+        payload = nonceNetID + _JOIN_ACCEPT_TAIL_STRUCT.pack(newDevAddr,
+                                                             0, # DLSettings
+                                                             0) # RxDelay
         mic = self.crypto.computeJoinMic(mhdr + payload)
 
         # encrypt the payload (not including MAC header)
@@ -258,19 +272,29 @@ class LoRaEndDevice:
         elif rxWindow == JOIN_ACCEPT_WINDOW_2:
             return self.joinAcceptDelay2_usec
         else:
-            self.logger.warn("Unexpected rxWindow parameter %d"%rxWindow)
+            self.logger.warn("Unexpected rxWindow parameter %d", rxWindow)
             return self.receiveDelay1_usec
 
+    # deque.append()/popleft() are atomic under the GIL, so the individual
+    # queue ops need no lock of their own. Callers that must make a
+    # check-then-pop sequence atomic (e.g. doDownlinkToDev) hold self.lock
+    # around the whole sequence instead.
     def putDownlinkMsg(self, msg):
-        with self.lock:
-            self.dlQueue.append(msg)
+        self.dlQueue.append(msg)
 
     def hasPendingDownlink(self):
         return len(self.dlQueue) != 0
 
     def popDownlinkMsg(self):
-        with self.lock:
+        return self.dlQueue.popleft()
+
+    def tryPopDownlink(self):
+        # Single atomic popleft instead of a check-then-pop pair; returns
+        # None when the queue is empty.
+        try:
             return self.dlQueue.popleft()
+        except IndexError:
+            return None
 
     def bindWithGateway(self, gatewayMacAddr, rssi):
         self.gateways.add(gatewayMacAddr)
@@ -316,6 +340,12 @@ class LoRaMacServer:
     DOWNSTREAM_BW500_SPACING_MHZ = 0.6
     DOWNSTREAM_BW500_NUM_CHAN = 8
 
+    # Spreading factors a gateway may report for each uplink bandwidth
+    UPSTREAM_BW125_DATARATES = ["SF7BW125", "SF8BW125", "SF9BW125",
+                                "SF10BW125", "SF11BW125", "SF12BW125"]
+    UPSTREAM_BW500_DATARATES = ["SF7BW500", "SF8BW500", "SF9BW500",
+                                "SF10BW500", "SF11BW500", "SF12BW500"]
+
     def __init__(self, networkID, sendToGatewayFn=None):
         self.networkID = networkID & 0x7F # 7-bit
         self.netID = self.networkID # 24-bit
@@ -323,6 +353,30 @@ class LoRaMacServer:
         self.euiToDevMap = {}
         self.addrToDevMap = {}
 
+        # Precomputed channel lookups, so the per-packet path is a plain
+        # dict/list access rather than substring scan + float arithmetic.
+        # Frequencies are keyed in units of 100 kHz to stay integral.
+        self._freqToChan = {}
+        for datr in self.UPSTREAM_BW125_DATARATES:
+            for chan in range(self.UPSTREAM_BW125_NUM_CHAN):
+                freqMHz = self.UPSTREAM_BW125_LOWEST_FREQ_MHZ + \
+                          chan * self.UPSTREAM_BW125_SPACING_MHZ
+                self._freqToChan[(datr, int(round(freqMHz * 10)))] = chan
+        for datr in self.UPSTREAM_BW500_DATARATES:
+            for chan in range(self.UPSTREAM_BW500_NUM_CHAN):
+                freqMHz = self.UPSTREAM_BW500_LOWEST_FREQ_MHZ + \
+                          chan * self.UPSTREAM_BW500_SPACING_MHZ
+                self._freqToChan[(datr, int(round(freqMHz * 10)))] = chan
+        self._rx1FreqTable = [self.DOWNSTREAM_BW500_LOWEST_FREQ_MHZ +
+                              (chan % self.DOWNSTREAM_BW500_NUM_CHAN) *
+                              self.DOWNSTREAM_BW500_SPACING_MHZ
+                              for chan in range(self.UPSTREAM_BW125_NUM_CHAN)]
+
+        # Shared worker pool for MIC computation. pycryptodome releases the
+        # GIL inside its AES code, so MICs from different gateway threads
+        # verify in parallel instead of serializing on one callback thread.
+        self._cryptoPool = ThreadPoolExecutor(max_workers=cpu_count())
+
         self.logger = logging.getLogger("LoRaMacServer")
         self.logger.setLevel(logging.INFO)
 
@@ -360,7 +414,7 @@ class LoRaMacServer:
         else:
             appKeyStr = appKey
 
-        self.euiToDevMap[(appEUI_int, devEUI_int)] = \
+        self.euiToDevMap[_euiMapKey(appEUI_int, devEUI_int)] = \
                                 LoRaEndDevice(appEUI_int, devEUI_int, appKeyStr)
 
     def scheduleAppDownlink(self, appEUI, devEUI, appPort, appPayload,
@@ -371,8 +425,8 @@ class LoRaMacServer:
         dev = self.getDevFromEUI(appEUI_int,devEUI_int)
         if dev == None or not dev.joined:
             self.logger.warn("Cannot send frame. Device not registered or not" \
-                             " joined (appEUI %x devEUI %x)"%(appEUI_int,
-                                                              devEUI_int))
+                             " joined (appEUI %x devEUI %x)", appEUI_int,
+                             devEUI_int)
             return -1
 
         with dev.lock:
@@ -391,8 +445,9 @@ class LoRaMacServer:
         '''
         Return a DownlinkMessage object
         '''
-        if len(dev.dlQueue) != 0:
-            return dev.dlQueue.popleft()
+        dlMsg = dev.tryPopDownlink()
+        if dlMsg != None:
+            return dlMsg
 
         # Retrieve pending app data
         frmPayload = None
@@ -443,17 +498,14 @@ class LoRaMacServer:
         return DownlinkMessage(phyPayload, RX_WINDOW_1)
 
     def getDevFromEUI(self, appEUI, devEUI):
-        if (appEUI, devEUI) in self.euiToDevMap:
-            return self.euiToDevMap[(appEUI, devEUI)]
-        else:
-            return None
+        return self.euiToDevMap.get(_euiMapKey(appEUI, devEUI))
 
     def onGatewayOnline(self, macAddr):
         '''
         Callback to be used by the connection layer/module. Called when a gateway
         makes a connection to the server.
         '''
-        self.logger.info("Gateway %x online"%macAddr)
+        self.logger.info("Gateway %x online", macAddr)
         pass
 
     def onGatewayOffline(self, macAddr):
@@ -461,25 +513,36 @@ class LoRaMacServer:
         Callback to be used by the connection layer/module. Called when a gateway
         disconnects from the server.
         '''
-        self.logger.info("Gateway %x offline"%macAddr)
+        self.logger.info("Gateway %x offline", macAddr)
         pass
 
+    # Reciprocals of the channel spacings, so the off-grid fallback multiplies
+    # instead of dividing
+    UPSTREAM_BW125_INV_SPACING = 1.0 / UPSTREAM_BW125_SPACING_MHZ
+    UPSTREAM_BW500_INV_SPACING = 1.0 / UPSTREAM_BW500_SPACING_MHZ
+
     def getUplinkChannelFromFreq(self, ulDatarate, ulFreqMHz):
-        if "500" in ulDatarate:
-            # BW500 channels
-            return round((ulFreqMHz - self.UPSTREAM_BW500_LOWEST_FREQ_MHZ) / \
-                         self.UPSTREAM_BW500_SPACING_MHZ) % \
-                   self.UPSTREAM_BW500_NUM_CHAN
-        else:
-            # BW125 channels
-            return round((ulFreqMHz - self.UPSTREAM_BW125_LOWEST_FREQ_MHZ) / \
-                         self.UPSTREAM_BW125_SPACING_MHZ) % \
-                   self.UPSTREAM_BW125_NUM_CHAN
+        try:
+            return self._freqToChan[(ulDatarate, int(round(ulFreqMHz * 10)))]
+        except KeyError:
+            # Off-grid frequency (e.g. gateway rounding error). Snap to the
+            # nearest channel, then memoize the result so each unique
+            # off-grid (datarate, frequency) pair is only computed once.
+            if "500" in ulDatarate:
+                chan = int(round((ulFreqMHz -
+                                  self.UPSTREAM_BW500_LOWEST_FREQ_MHZ) *
+                                 self.UPSTREAM_BW500_INV_SPACING)) % \
+                       self.UPSTREAM_BW500_NUM_CHAN
+            else:
+                chan = int(round((ulFreqMHz -
+                                  self.UPSTREAM_BW125_LOWEST_FREQ_MHZ) *
+                                 self.UPSTREAM_BW125_INV_SPACING)) % \
+                       self.UPSTREAM_BW125_NUM_CHAN
+            self._freqToChan[(ulDatarate, int(round(ulFreqMHz * 10)))] = chan
+            return chan
 
     def getRxWindow1Freq(self, ulChannel):
-        return self.DOWNSTREAM_BW500_LOWEST_FREQ_MHZ + \
-               (ulChannel % self.DOWNSTREAM_BW500_NUM_CHAN) * \
-               self.DOWNSTREAM_BW500_SPACING_MHZ
+        return self._rx1FreqTable[ulChannel]
 
     def getRxWindow1DataRate(self, ulDatarate):
         # [TODO]: Take RX1DROffsest into account.
@@ -489,48 +552,49 @@ class LoRaMacServer:
 
     def doDownlinkToDev(self, dev, eouTimestamp, ulChannel, ulDatarate,
                         ulCodingrate):
-        # make the following ops atomic
+        # Only the dequeue/frame-assembly needs to be atomic (it consumes the
+        # pending queues and bumps the downlink frame counter). The JSON
+        # build below touches only locals and per-device constants, so it
+        # runs outside the lock.
         with dev.lock:
             dlMsg = self.prepareDownlinkMsg(dev)
-            if dlMsg == None:
-                # nothing to do
-                self.logger.info("[doDownlinkToDev] No queued downlink")
-                return 0
 
-            ## Find out the time for the RX window
-            delayUsec = dev.getRxWindowDelayUsec(dlMsg.rxWindow)
-            dlTimestamp = eouTimestamp + int(delayUsec)
-
-            ## Prepare the JSON payload
-            jsonDict = {}
-            # Receive window specific settings
-            if (dlMsg.rxWindow == RX_WINDOW_1 or
-                dlMsg.rxWindow == JOIN_ACCEPT_WINDOW_1):
-                jsonDict["freq"] = self.getRxWindow1Freq(ulChannel)
-                jsonDict["datr"] = self.getRxWindow1DataRate(ulDatarate)
-                jsonDict["codr"] = ulCodingrate
-            else:
-                jsonDict["freq"] = dev.rx2FreqMHz
-                jsonDict["datr"] = dev.rx2Datarate
-                jsonDict["codr"] = dev.rx2Codingrate
-            # Settings not specific to receiving window
-            jsonDict["tmst"] = dlTimestamp
-            jsonDict["rfch"] = 0 # TODO: get this from the gateway object
-            jsonDict["powe"] = 20 # TODO: magic number
-            jsonDict["modu"] = dev.dlModulation
-            jsonDict["ipol"] = dev.dlIpol
-            #jsonDict["prea"] = dev.dlNumPreamble
-            jsonDict["size"] = dlMsg.payloadSize
-            jsonDict["data"] = dlMsg.payloadBase64
-            payloadToGw = json.dumps({"txpk":jsonDict}, separators=(',',':'))
+        if dlMsg == None:
+            # nothing to do
+            self.logger.info("[doDownlinkToDev] No queued downlink")
+            return 0
+
+        ## Find out the time for the RX window
+        delayUsec = dev.getRxWindowDelayUsec(dlMsg.rxWindow)
+        dlTimestamp = eouTimestamp + int(delayUsec)
+
+        ## Prepare the JSON payload from the per-device template.
+        ## Receive window specific settings pick the template; only the
+        ## per-packet fields are interpolated here.
+        if (dlMsg.rxWindow == RX_WINDOW_1 or
+            dlMsg.rxWindow == JOIN_ACCEPT_WINDOW_1):
+            dlFreq = self.getRxWindow1Freq(ulChannel)
+            dlDatarate = self.getRxWindow1DataRate(ulDatarate)
+            dlCodingrate = ulCodingrate
+            payloadToGw = dev.dlJsonTemplateRx1 % (dlFreq, dlDatarate,
+                                                   dlCodingrate,
+                                                   dlTimestamp,
+                                                   dlMsg.payloadSize,
+                                                   dlMsg.payloadBase64)
+        else:
+            dlFreq = dev.rx2FreqMHz
+            dlDatarate = dev.rx2Datarate
+            dlCodingrate = dev.rx2Codingrate
+            payloadToGw = dev.dlJsonTemplateRx2 % (dlTimestamp,
+                                                   dlMsg.payloadSize,
+                                                   dlMsg.payloadBase64)
 
         # Send the JSON payload to the corresponding gateway
         gwMacAddr = dev.getGatewayForDownlink()
         self.logger.info("[doDownlinkToDev] Downlink to dev %x via gateway %x" \
                          " with RF params tmst:%d freq:%f datr:%s codr:%s " \
-                         "plsize:%d"%(dev.devAddr, gwMacAddr, jsonDict["tmst"],\
-                                      jsonDict["freq"], jsonDict["datr"], \
-                                      jsonDict["codr"], jsonDict["size"]))
+                         "plsize:%d", dev.devAddr, gwMacAddr, dlTimestamp,
+                         dlFreq, dlDatarate, dlCodingrate, dlMsg.payloadSize)
         if self.sendToGateway != None:
             self.sendToGateway(gwMacAddr, payloadToGw)
         else:
@@ -544,7 +608,52 @@ class LoRaMacServer:
         gatewayMacAddr: MAC address of the source gateway
         jsonDict: resulting dictionary after JSON object has been parsed
         '''
+        # decode padded Base64 RF packet
+        phyPayload = pybase64.b64decode(jsonDict["data"])
+        return self._processRxPacket(gatewayMacAddr, jsonDict, phyPayload)
 
+    def processRawRxPayloadBatch(self, gatewayMacAddr, rxpkList):
+        '''
+        Bulk variant of processRawRxPayload for gateways that push several
+        "rxpk" objects in one PUSH_DATA packet. Base64-decodes all payloads
+        up front and pulls the EUIs out of every join request in a single
+        numpy pass, so the per-packet interpreter overhead is amortized over
+        the batch.
+
+        gatewayMacAddr: MAC address of the source gateway
+        rxpkList: list of parsed "rxpk" JSON dictionaries
+        '''
+        payloads = [pybase64.b64decode(rxpk["data"]) for rxpk in rxpkList]
+
+        # Gather the AppEUI/DevEUI pairs of all join requests (bytes 1..16 of
+        # the PHY payload) into one buffer and view it as little-endian u64.
+        joinIdx = [i for i, p in enumerate(payloads)
+                   if len(p) >= 23 and
+                      (ord(p[0]) & 0b11100000) == MTYPE_JOIN_REQUEST_MASK]
+        joinEUIMap = {}
+        if len(joinIdx) != 0:
+            euiBuf = b''.join([payloads[i][1:17] for i in joinIdx])
+            euis = numpy.frombuffer(euiBuf, dtype='<u8')
+            for n, i in enumerate(joinIdx):
+                joinEUIMap[i] = (int(euis[2*n]), int(euis[2*n+1]))
+
+        results = []
+        for i, rxpk in enumerate(rxpkList):
+            results.append(self._processRxPacket(gatewayMacAddr, rxpk,
+                                                 payloads[i],
+                                                 joinEUIMap.get(i)))
+        return results
+
+    def _processRxPacket(self, gatewayMacAddr, jsonDict, phyPayload,
+                         joinEUIs=None):
+        '''
+        Common per-packet path shared by processRawRxPayload and
+        processRawRxPayloadBatch.
+
+        phyPayload: the Base64-decoded RF packet
+        joinEUIs: optional pre-extracted (appEUI, devEUI) pair for join
+                  requests, as produced by the batch path
+        '''
         ### Process gateway metadata
         eouTimestamp = jsonDict["tmst"] # in usec
         ulFreqMHz = jsonDict["freq"]
@@ -554,25 +663,29 @@ class LoRaMacServer:
         ulChannel = self.getUplinkChannelFromFreq(ulDatarate, ulFreqMHz)
 
         self.logger.info("Got packet with tmst:%d freq:%f datarate:%s codr:%s" \
-                         " rssi:%d"%(eouTimestamp, ulFreqMHz, ulDatarate, 
-                                     ulCodingrate, ulRssi))
-
-        # decode padded Base64 RF packet
-        phyPayload = base64.b64decode(jsonDict["data"])
+                         " rssi:%d", eouTimestamp, ulFreqMHz, ulDatarate,
+                         ulCodingrate, ulRssi)
 
         ### Process the PHY payload, whose structure is:
         ### | MHDR | MACPayload | MIC |
+        # Slice through a memoryview so header/MIC extraction reads the
+        # decoded packet in place instead of copying each piece.
         mhdrByte = ord(phyPayload[0])
-        macPayload = phyPayload[1:-4]
-        mic = phyPayload[-4:]
-        
+        phyView = memoryview(phyPayload)
+        macPayload = phyView[1:-4]
+        mic = phyView[-4:].tobytes()
+
+
         # MHDR: | (7..5) MType | (4..2) RFU | (1..0) Major |
         mtype = mhdrByte & 0b11100000
 
         if mtype == MTYPE_JOIN_REQUEST_MASK:
-            appEUI = struct.unpack("<Q", macPayload[0:8])[0] # little endian
-            devEUI = struct.unpack("<Q", macPayload[8:16])[0]
-            devNonce = struct.unpack("<H",macPayload[16:18])[0]
+            if joinEUIs != None:
+                appEUI, devEUI = joinEUIs
+                devNonce = struct.unpack_from("<H", macPayload, 16)[0]
+            else:
+                appEUI, devEUI, devNonce = \
+                            _JOIN_REQ_STRUCT.unpack_from(macPayload, 0)
 
             dev = self.getDevFromEUI(appEUI, devEUI)
             if dev == None:
@@ -581,10 +694,15 @@ class LoRaMacServer:
                 self.logger.info("Cannot get device from EUI")
                 return -1
 
-            # Check message integrity (MIC)
-            if mic != dev.crypto.computeJoinMic(phyPayload[:-4]):
+            # Check message integrity (MIC). The CMAC runs on the crypto
+            # pool so this thread can do the replay bookkeeping meanwhile.
+            # compare_digest is constant-time, so a forger learns nothing
+            # from how fast the check fails.
+            micFuture = self._cryptoPool.submit(dev.crypto.computeJoinMic,
+                                                phyView[:-4])
+            if not hmac.compare_digest(mic, micFuture.result()):
                 self.logger.info("Bad packet Message Integrity Code. " \
-                                 "MType: %d"%mtype)
+                                 "MType: %d", mtype)
                 return -2
 
             # Handle join request. Should allocate a network address for the
@@ -601,10 +719,10 @@ class LoRaMacServer:
             # where FHDR is:
             # | DevAddr | FCtrl | FCnt | Fopts |
 
-            devAddr = struct.unpack("<L", macPayload[0:4])[0] # little endian
+            devAddr = struct.unpack_from("<L", macPayload, 0)[0] # little endian
             if devAddr not in self.addrToDevMap:
                 self.logger.info("Device %x has not joined yet. Dropping " \
-                                 "data frame."%devAddr)
+                                 "data frame.", devAddr)
                 return -1
 
             dev = self.addrToDevMap[devAddr]
@@ -613,7 +731,7 @@ class LoRaMacServer:
             fCtrl = ord(macPayload[4])
             fOptsLen = fCtrl & FCTRL_FOPTS_LEN_MASK
             fPortIdx = 7 + fOptsLen
-            upSeqCnt_u16 = struct.unpack("<H", macPayload[5:7])[0]
+            upSeqCnt_u16 = struct.unpack_from("<H", macPayload, 5)[0]
 
             # Correct the 16-bit frame counter for roll-over
             upSeqCntDiff = (upSeqCnt_u16 - (dev.upSeqCnt_u32 & 0xFFFF))
@@ -624,16 +742,17 @@ class LoRaMacServer:
                 # (naively) assume we have ONE 16-bit roll-over.
                 upSeqCntTemp_u32 = dev.upSeqCnt_u32 + 0x10000 + upSeqCntDiff
 
-            # Verify message integrity
-            micCalc = dev.crypto.computeFrameMic(phyPayload[:-4], 
-                                                 UP_LINK,
-                                                 devAddr,
-                                                 upSeqCntTemp_u32,
-                                                 len(phyPayload[:-4]))
+            # Verify message integrity on the crypto pool
+            micFuture = self._cryptoPool.submit(dev.crypto.computeFrameMic,
+                                                phyView[:-4],
+                                                UP_LINK,
+                                                devAddr,
+                                                upSeqCntTemp_u32,
+                                                len(phyPayload) - 4)
 
-            if mic != micCalc:
+            if not hmac.compare_digest(mic, micFuture.result()):
                 self.logger.info("Bad packet Message Integrity Code. " \
-                                 "MType: %d"%mtype)
+                                 "MType: %d", mtype)
                 return -2
 
             # Handle duplicate packets
@@ -649,13 +768,13 @@ class LoRaMacServer:
 
             if fOptsLen > 0:
                 # fOpts contains piggybacked MAC commands (unencrypted)
-                self.processMacCommands(dev, macPayload[7:fPortIdx])
+                self.processMacCommands(dev, macPayload[7:fPortIdx].tobytes())
 
             # "If the frame payload field is not empty, the FPort field must
             # be present" (LoRaWAN specification v1.0 Ch4.3.2)
             if fPortIdx < len(macPayload):
                 fPort = ord(macPayload[fPortIdx])
-                frmPayload = macPayload[fPortIdx+1:]
+                frmPayload = macPayload[fPortIdx+1:].tobytes()
 
                 if fPort == 0:
                     # frmPayload carries MAC commands, encrypted using the
@@ -673,7 +792,7 @@ class LoRaMacServer:
             #TODO: make sure the network ID in devAddr matches our network ID
         else:
             # Invalid MAC message type. Bail.
-            self.logger.info("Got invalid MAC message type: %d"%mtype)
+            self.logger.info("Got invalid MAC message type: %d", mtype)
             return -1
 
         # Remember that this gateway has access to the device
@@ -694,13 +813,12 @@ class LoRaMacServer:
 
         devAddr == | 7-bit NetworkID | 25-bit NetworkAddress |
         '''
+        networkID_shifted = self.networkID << 25
         while True:
-            networkID_shifted = self.networkID << 25
-            networkAddr = random.randint(0, (1<<25)-1)
-            devAddr = networkID_shifted | networkAddr
+            devAddr = networkID_shifted | _sysRandom.getrandbits(25)
             if devAddr not in self.addrToDevMap:
                 break
-        
+
         return devAddr
 
     def handleJoinRequest(self, dev, devNonce):
@@ -714,9 +832,9 @@ class LoRaMacServer:
             del self.addrToDevMap[dev.devAddr]
         newDevAddr = self.genDevAddr()
         self.addrToDevMap[newDevAddr] = dev
-        self.logger.info("[handleJoinRequest] Allocated devAddr %x"%newDevAddr)
+        self.logger.info("[handleJoinRequest] Allocated devAddr %x", newDevAddr)
 
-        appNonce = random.randint(0, (1<<24)-1) & 0xFFFFFF
+        appNonce = _sysRandom.getrandbits(24)
         # This method will generate and queue the join-accept message
         dev.onJoin(newDevAddr, appNonce, devNonce, self.netID)
 
@@ -724,4 +842,7 @@ class DownlinkMessage:
     def __init__(self, payloadByteStr, rxWindow):
         self.payloadSize = len(payloadByteStr)
         self.rxWindow = rxWindow
-        self.payloadBase64 = base64.b64encode(payloadByteStr)
\ No newline at end of file
+        # Encoded once at queue time (pybase64 uses SIMD encoders where the
+        # CPU supports them); doDownlinkToDev interpolates it straight into
+        # the JSON template.
+        self.payloadBase64 = pybase64.b64encode(payloadByteStr)
\ No newline at end of file